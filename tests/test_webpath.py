@@ -0,0 +1,65 @@
+from pathlib import Path
+from stat import S_IFDIR, S_IFREG
+
+from paramiko import sftp, sftp_attr
+
+from webpath.server import SFTPHandler, TreeList
+from webpath.webpath import WebPath
+
+
+def make_attr(filename, st_mode, st_mtime=0):
+    # What listdir_attr would hand to WebPath.from_attr
+    attr = sftp_attr.SFTPAttributes()
+    attr.filename = filename
+    attr.st_mode = st_mode
+    attr.st_mtime = st_mtime
+    return attr
+
+
+def test_local_tree_relative_to(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "file.txt").write_text("hello")
+    (tmp_path / "top.txt").write_text("world")
+
+    tree = TreeList.from_walk(SFTPHandler._local_walk(tmp_path),
+                              root=tmp_path)
+
+    # relative_to used to reference an undefined self._system and
+    # raise AttributeError mid-walk
+    rels = {p.relative_to(tree.root).as_posix() for p in tree.paths}
+    assert rels == {"sub", "sub/file.txt", "top.txt"}
+
+
+def test_remote_tree_relative_to():
+    root = "site"
+    paths = (
+        WebPath.from_attr(root, None, make_attr("assets", S_IFDIR)),
+        WebPath.from_attr("site/assets", None,
+                          make_attr("logo.png", S_IFREG)),
+    )
+    tree = TreeList(root, paths)
+
+    rels = [p.relative_to(tree.root).as_posix() for p in tree.paths]
+    assert rels == ["assets", "assets/logo.png"]
+
+    assert tree.directories == [paths[0]]
+    assert tree.files == [paths[1]]
+
+
+class _Handle:
+    def get_binary(self):
+        return b"handle"
+
+
+class CloseFailsAccessor:
+    # Opens fine, but fails to close the handle
+    def _request(self, cmd, *args):
+        if cmd == sftp.CMD_OPEN:
+            return sftp.CMD_HANDLE, _Handle()
+        raise IOError("close failed")
+
+
+def test_touch_swallows_close_failure():
+    # touch caught a misspelled 'Excpetion', so a close failure raised
+    # NameError instead of being ignored
+    WebPath(Path("file.txt"), CloseFailsAccessor()).touch()
@@ -0,0 +1,69 @@
+"""Async counterpart to webpath.server, built on asyncssh.
+
+asyncssh keeps many READ/WRITE requests in flight on a single SFTP
+channel, so recursive transfers of small files approach bandwidth
+limits instead of one round-trip per request. asyncssh is an optional
+dependency; the paramiko-based SFTPHandler remains the synchronous
+default and this module is not imported by the package itself.
+"""
+import asyncssh
+from contextlib import asynccontextmanager
+
+
+@asynccontextmanager
+async def AsyncSFTPClient(**cfg):
+    # hostname (paramiko naming) is translated to asyncssh's host;
+    # username, password and port mean the same in both libraries and
+    # pass straight through. Other paramiko connect kwargs (e.g.
+    # key_filename, look_for_keys) have no asyncssh equivalent here —
+    # pass asyncssh.connect options instead.
+    host = cfg.pop("hostname", cfg.pop("host", None))
+    async with asyncssh.connect(host, known_hosts=None, **cfg) as conn:
+        async with conn.start_sftp_client() as sftp:
+            yield AsyncSFTPHandler(sftp)
+
+
+class AsyncSFTPHandler:
+    # max_requests/block_size bound the pipelining per transfer:
+    # up to max_requests simultaneous requests of block_size bytes
+    def __init__(self, sftp, max_requests=128, block_size=16384):
+        self.sftp = sftp
+        self.max_requests = max_requests
+        self.block_size = block_size
+
+    async def get(self, remotepath, localpath, preserve_mtime=False):
+        await self.sftp.get(
+            str(remotepath), str(localpath), preserve=preserve_mtime,
+            max_requests=self.max_requests, block_size=self.block_size)
+
+    async def put(self, localpath, remotepath, preserve_mtime=False):
+        await self.sftp.put(
+            str(localpath), str(remotepath), preserve=preserve_mtime,
+            max_requests=self.max_requests, block_size=self.block_size)
+
+    async def get_r(self, remotepath, localpath, preserve_mtime=False):
+        await self.sftp.get(
+            str(remotepath), str(localpath), recurse=True,
+            preserve=preserve_mtime,
+            max_requests=self.max_requests, block_size=self.block_size)
+
+    async def put_r(self, localpath, remotepath, preserve_mtime=False):
+        await self.sftp.put(
+            str(localpath), str(remotepath), recurse=True,
+            preserve=preserve_mtime,
+            max_requests=self.max_requests, block_size=self.block_size)
+
+    async def rm_r(self, remotepath, remove_root=False):
+        remotepath = str(remotepath)
+        if remove_root:
+            await self.sftp.rmtree(remotepath)
+            return
+
+        for name in await self.sftp.listdir(remotepath):
+            if name in (".", ".."):
+                continue
+            path = f"{remotepath}/{name}"
+            if await self.sftp.isdir(path):
+                await self.sftp.rmtree(path)
+            else:
+                await self.sftp.remove(path)
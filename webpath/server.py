@@ -1,15 +1,21 @@
 import paramiko
+import functools
+from paramiko import sftp
+import json
 import logging
 import os
-from collections import namedtuple
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
+from stat import S_ISDIR, S_ISREG
+from urllib.parse import quote
 from .webpath import WebPath
 
 
-logging.basicConfig()
 logger = logging.getLogger(__name__)
-logger.setLevel(level=logging.DEBUG)
 
 
 class ServerClient:
@@ -49,69 +55,188 @@ def SFTPClient(**cfg):
 
 
 class ClientHandler(Handler):
+    # AES-GCM encrypts and authenticates in one hardware-accelerated
+    # pass, unlike CTR mode plus a separate HMAC
+    _FAST_CIPHERS = ("aes128-gcm@openssh.com", "aes256-gcm@openssh.com")
+
     def __init__(self, client, config):
         self.client = client
+        self.config = config
+
+        # Besides paramiko's own connect kwargs (e.g. compress=True,
+        # worthwhile for text-heavy trees), fast_cipher=True restricts
+        # negotiation to the GCM ciphers. paramiko has no
+        # cipher-preference kwarg, so the slower ones are disabled.
+        config = dict(config)
+        if config.pop("fast_cipher", False):
+            disabled = dict(config.get("disabled_algorithms") or {})
+            disabled.setdefault("ciphers", [
+                c for c in paramiko.Transport._preferred_ciphers
+                if c not in self._FAST_CIPHERS])
+            config["disabled_algorithms"] = disabled
+
         self.client.connect(**config)
 
+        # Enlarge the SSH window and packet size so pipelined SFTP
+        # requests aren't throttled by paramiko's small defaults.
+        # These apply to channels opened after connect, i.e. the SFTP
+        # channel created by sftp().
+        transport = self.client.get_transport()
+        transport.default_window_size = 2**27
+        transport.default_max_packet_size = 2**19
+
     def close(self):
         self.client.close()
 
     def sftp(self):
-        return SFTPHandler.from_transport(self.client.get_transport())
+        handler = SFTPHandler.from_transport(self.client.get_transport())
+        handler._config = self.config
+        return handler
 
 
 class TreeList(namedtuple("TreeList", "root paths")):
     @classmethod
     def from_walk(cls, walk, root):
-        return cls(root, list(walk))
+        # tuple rather than list: the tree is never mutated, and a
+        # tuple is a bit smaller for the 10^5-entry walks
+        return cls(root, tuple(walk))
+
+    @functools.cached_property
+    def _partition(self):
+        # Single pass over self.paths: separate filters would re-check
+        # (and potentially re-stat) every entry up to three times.
+        # The mode is fetched once per entry; is_dir() + is_file()
+        # would each pay a method call and a cache lookup.
+        directories, files, unknowns = [], [], []
+        for p in self.paths:
+            try:
+                mode = p.stat().st_mode
+            except FileNotFoundError:
+                mode = 0
+            if S_ISDIR(mode):
+                directories.append(p)
+            elif S_ISREG(mode):
+                files.append(p)
+            else:
+                unknowns.append(p)
+        return directories, files, unknowns
 
     @property
     def directories(self):
-        return filter(lambda p: p.is_dir(), self.paths)
+        return self._partition[0]
 
     @property
     def files(self):
-        return filter(lambda p: p.is_file(), self.paths)
+        return self._partition[1]
 
     @property
     def unknowns(self):
-        return filter(lambda p: not (p.is_dir or p.is_file()), self.paths)
+        return self._partition[2]
+
+    @functools.cached_property
+    def _file_set(self):
+        # WebPaths compare by identity, so hash the underlying paths
+        return frozenset(getattr(p, "_path", p) for p in self.files)
 
     def __contains__(self, path):
-        return any(path == p for p in self.files)
+        return getattr(path, "_path", path) in self._file_set
 
     def _key(self, path):
         # * st_mtime is a float on a system, an int on the web
         # * stat.st_size can additionally be used for files
         #   but can be different on system and web
-        stat = path.stat()
-        rel = path.relative_to(self.root).as_posix()
-        return (rel, int(stat.st_mtime))
+        return (self._rel(path), int(path.stat().st_mtime))
+
+    @functools.cached_property
+    def _root_prefix(self):
+        root = Path(str(self.root)).as_posix()
+        return "" if root == "." else root.rstrip("/") + "/"
+
+    @functools.cached_property
+    def _rel_cache(self):
+        return {}
 
     def _rel(self, path):
-        return path.relative_to(self.root).as_posix()
+        # relative_to allocates a new PurePath per call; diff/mod call
+        # this for every entry, so strip the root prefix from the posix
+        # string instead and memoize per instance.
+        posix = path.as_posix()
+        cache = self._rel_cache
+        try:
+            return cache[posix]
+        except KeyError:
+            pass
+
+        prefix = self._root_prefix
+        if not prefix:
+            rel = posix
+        elif posix.startswith(prefix):
+            rel = posix[len(prefix):]
+        else:
+            rel = path.relative_to(self.root).as_posix()
+
+        cache[posix] = rel
+        return rel
 
     def diff(self, other):
         # Returns a new tree which contains the different paths
-        paths = set(map(other._rel, other.paths))
+        rels = {other._rel(p) for p in other.paths}
 
         return self.__class__(
             self.root,
-            list(map(lambda p: self._rel(p) not in paths, self.paths)),
+            tuple(p for p in self.paths if self._rel(p) not in rels),
         )
 
     def mod(self, other):
-        # Returns a new tree which contains the modified paths
-        paths = set(map(other._key, other.paths))
+        # Returns a new tree which contains the new and modified paths
+        keys = {other._rel(p): int(p.stat().st_mtime) for p in other.paths}
+        return self._mod_keys(keys)
 
+    def _mod_keys(self, keys):
+        # As mod, but against a plain {rel: mtime} mapping (e.g. a
+        # cached manifest) instead of another tree
         return self.__class__(
             self.root,
-            list(map(lambda p: self._key(p) not in paths, self.paths)),
+            tuple(p for p in self.paths
+                  if keys.get(self._rel(p)) != int(p.stat().st_mtime)),
         )
 
 
 class SFTPHandler(paramiko.sftp_client.SFTPClient):
     _Path = WebPath
+    # Connection kwargs, set by ClientHandler.sftp so that worker threads
+    # can open their own connections.
+    _config = None
+
+    def _transfer_map(self, transfer, pairs, concurrency):
+        # Runs transfer(sftp, src, dst) for every (src, dst) pair.
+        # paramiko channels are not thread-safe, so each worker thread
+        # lazily opens its own SSH+SFTP connection from _config.
+        if concurrency == 1 or self._config is None:
+            for src, dst in pairs:
+                transfer(self, src, dst)
+            return
+
+        local = threading.local()
+        handlers = []
+
+        def worker(pair):
+            handler = getattr(local, "handler", None)
+            if handler is None:
+                handler = ServerClient.ssh().sftp_connect(**self._config)
+                local.handler = handler
+                handlers.append(handler)
+            src, dst = pair
+            transfer(handler.sftp, src, dst)
+
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                # consume the iterator so worker exceptions propagate
+                for _ in executor.map(worker, pairs):
+                    pass
+        finally:
+            for handler in handlers:
+                handler.close()
 
     def chdir(self, path=None):
         # Since _adjust_cwd is not exposed, we can't normalize paths
@@ -122,14 +247,20 @@ class SFTPHandler(paramiko.sftp_client.SFTPClient):
 
         return FileHandler(
             super().open(filename, mode=mode, bufsize=buffering),
-            encoding, errors, newline)
+            encoding, errors, newline, mode=mode)
 
     def _walk(self, path=".", recurse=True):
-        for attr in self.listdir_attr(path):
-            node = self._Path.from_attr(path, self, attr)
-            yield node
-            if recurse and node.is_dir():
-                yield from self._walk(node.as_posix(), recurse)
+        # Explicit work queue instead of per-directory recursion: no
+        # recursion limit on deep trees. Directories come out in
+        # breadth-first order, so parents always precede children.
+        queue = deque([path])
+        while queue:
+            directory = queue.popleft()
+            for attr in self.listdir_attr(directory):
+                node = self._Path.from_attr(directory, self, attr)
+                yield node
+                if recurse and node.is_dir():
+                    queue.append(node.as_posix())
 
     def listdir_r(self, path="."):
         for node in self._walk(path):
@@ -140,8 +271,29 @@ class SFTPHandler(paramiko.sftp_client.SFTPClient):
 
     tree = _remote_tree
 
+    @staticmethod
+    def _local_walk(path):
+        # os.scandir caches the stat on the DirEntry, so each local
+        # entry is stat'ed once; rglob stats again for every is_dir/
+        # stat call downstream. Yields WebPaths with the stat
+        # pre-cached, mirroring _walk/from_attr on the remote side.
+        queue = deque([path])
+        while queue:
+            directory = queue.popleft()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat()
+                    except OSError:  # e.g. broken symlink
+                        stat = entry.stat(follow_symlinks=False)
+                    yield WebPath(Path(entry.path), stat=stat)
+                    # don't recurse into symlinked directories (rglob
+                    # doesn't either); a cycle would hang the walk
+                    if entry.is_dir(follow_symlinks=False):
+                        queue.append(entry.path)
+
     def _local_tree(self, path="."):
-        return TreeList.from_walk(Path(path).rglob("*"), root=path)
+        return TreeList.from_walk(self._local_walk(path), root=path)
 
     def _copy_remote_time(self, localpath, remotepath):
         stat = self.stat(remotepath)
@@ -151,6 +303,17 @@ class SFTPHandler(paramiko.sftp_client.SFTPClient):
         stat = os.stat(localpath)
         self.utime(remotepath, (stat.st_atime, stat.st_mtime))
 
+    def _utime_many(self, pairs, window=64):
+        # Pipelined utime for (remotepath, (st_atime, st_mtime)) pairs;
+        # one round-trip per `window` instead of one per path.
+        def requests():
+            for remotepath, times in pairs:
+                attr = paramiko.SFTPAttributes()
+                attr.st_atime, attr.st_mtime = times
+                yield (str(remotepath), attr)
+
+        self._request_many(sftp.CMD_SETSTAT, requests(), window)
+
     def Path(self, remotepath):
         return self._Path(Path(remotepath), self)
 
@@ -162,41 +325,79 @@ class SFTPHandler(paramiko.sftp_client.SFTPClient):
         except IOError: # no such file
             return False
 
+    def _fast_get(self, remotepath, localpath, block_size=2**18):
+        # readv pipelines the READs for all chunks up front; each reply
+        # is written at its own offset with pwrite, skipping the
+        # BufferedWriter copy inside paramiko's get.
+        with super().open(str(remotepath), "rb") as rf:
+            size = rf.stat().st_size
+            chunks = [(offset, min(block_size, size - offset))
+                      for offset in range(0, size, block_size)]
+
+            fd = os.open(localpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o666)
+            try:
+                for data, (offset, _) in zip(rf.readv(chunks), chunks):
+                    os.pwrite(fd, data, offset)
+            finally:
+                os.close(fd)
+
     def get(self, remotepath, localpath, callback=None, prefetch=True,
             preserve_mtime=False):
         # Copied from https://bitbucket.org/dundeemt/pysftp
 
-        super().get(remotepath, localpath, callback=callback,
-            prefetch=prefetch)
+        if callback is None and prefetch and hasattr(os, "pwrite"):
+            self._fast_get(remotepath, localpath)
+        else:
+            super().get(remotepath, localpath, callback=callback,
+                prefetch=prefetch)
 
         if preserve_mtime:
             self._copy_remote_time(localpath, remotepath)
 
     def get_r(self, remotepath, localpath, callback=None, prefetch=True,
-            preserve_mtime=False):
+            preserve_mtime=False, concurrency=8):
 
         remotepath = Path(remotepath)
         localpath = Path(localpath)
 
         tree = self._remote_tree(remotepath.as_posix())
 
+        # Directories are created on the main connection so parents are
+        # guaranteed to exist before their children.
         for rd in tree.directories:
             ld = localpath / rd.relative_to(remotepath)
             ld.mkdir(exist_ok=True)
             if preserve_mtime:
-                self._copy_remote_time(ld, rd)
+                # the walk already cached the stat; no extra round-trip
+                stat = rd.stat()
+                os.utime(ld, (stat.st_atime, stat.st_mtime))
+
+        def transfer(sftp, rf, lf):
+            sftp.get(rf, lf, callback=callback, prefetch=prefetch)
+            if preserve_mtime:
+                stat = rf.stat()
+                os.utime(lf, (stat.st_atime, stat.st_mtime))
 
-        for rf in tree.files:
-            lf = localpath / rf.relative_to(remotepath)
-            self.get(rf, lf, callback=callback, prefetch=prefetch,
-                preserve_mtime=preserve_mtime)
+        pairs = ((rf, localpath / rf.relative_to(remotepath))
+                 for rf in tree.files)
+        self._transfer_map(transfer, pairs, concurrency)
 
     def put(self, localpath, remotepath, callback=None, confirm=True,
             preserve_mtime=False):
 
-        sftpattrs = super().put(localpath, remotepath, callback=callback,
-                                confirm=confirm)
-        logger.debug(f"Created {remotepath}")
+        file_size = os.stat(localpath).st_size
+        # 1 MiB buffered reads on the local side; putfo pipelines the
+        # remote WRITEs (set_pipelined) so they don't wait per-chunk.
+        with open(localpath, "rb", buffering=2**20) as fl:
+            if hasattr(os, "posix_fadvise"):
+                # ask the kernel to read ahead asynchronously, so
+                # local reads overlap the remote writes
+                os.posix_fadvise(fl.fileno(), 0, 0,
+                                 os.POSIX_FADV_SEQUENTIAL)
+            sftpattrs = super().putfo(fl, remotepath, file_size,
+                                      callback=callback, confirm=confirm)
+        logger.debug("Created %s", remotepath)
 
         if preserve_mtime:
             self._copy_local_time(localpath, remotepath)
@@ -205,7 +406,9 @@ class SFTPHandler(paramiko.sftp_client.SFTPClient):
         return sftpattrs
 
     def _put_tree(self, tree, remotepath, callback=None, confirm=True,
-            preserve_mtime=False):
+            preserve_mtime=False, concurrency=8):
+
+        utimes = []
 
         for ld in tree.directories:
             rd = (remotepath / ld.relative_to(tree.root)).as_posix()
@@ -213,19 +416,30 @@ class SFTPHandler(paramiko.sftp_client.SFTPClient):
                 continue
 
             if not self.isdir(rd):
-                logger.debug(f"Created {rd}")
+                logger.debug("Created %s", rd)
                 self.mkdir(rd)
 
             if preserve_mtime:
-                self._copy_remote_time(ld, rd)
+                # cached by the local walk
+                stat = ld.stat()
+                utimes.append((rd, (stat.st_atime, stat.st_mtime)))
+
+        def transfer(sftp, lf, rf):
+            sftp.put(lf, rf, callback=callback, confirm=confirm)
+            if preserve_mtime:
+                stat = lf.stat()
+                utimes.append((rf, (stat.st_atime, stat.st_mtime)))
 
-        for lf in tree.files:
-            rf = (remotepath / lf.relative_to(tree.root)).as_posix()
-            self.put(lf, rf, callback=callback, confirm=confirm,
-                     preserve_mtime=preserve_mtime)
+        pairs = ((lf, (remotepath / lf.relative_to(tree.root)).as_posix())
+                 for lf in tree.files)
+        self._transfer_map(transfer, pairs, concurrency)
+
+        # Batched after the transfers, so directory mtimes aren't
+        # clobbered by files created inside them afterwards.
+        self._utime_many(utimes)
 
     def put_r(self, localpath, remotepath, callback=None, confirm=True,
-            preserve_mtime=False):
+            preserve_mtime=False, concurrency=8):
 
         remotepath = Path(remotepath)
         localpath = Path(localpath)
@@ -233,28 +447,88 @@ class SFTPHandler(paramiko.sftp_client.SFTPClient):
         tree = self._local_tree(localpath)
 
         self._put_tree(tree, remotepath, callback=callback, confirm=confirm,
-            preserve_mtime=preserve_mtime)
+            preserve_mtime=preserve_mtime, concurrency=concurrency)
+
+    def _manifest_path(self, remotepath):
+        host = None
+        if self._config is not None:
+            host = self._config.get("hostname") or self._config.get("host")
+        if host is None:
+            host = self.sock.get_transport().getpeername()[0]
+
+        name = quote(str(remotepath), safe="") + ".json"
+        return Path.home() / ".cache" / "webpath" / str(host) / name
+
+    def _load_manifest(self, remotepath, max_age=None):
+        path = self._manifest_path(remotepath)
+        try:
+            if (max_age is not None
+                    and time.time() - path.stat().st_mtime > max_age):
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_manifest(self, remotepath, keys):
+        path = self._manifest_path(remotepath)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(keys, f)
 
     def put_diff(self, localpath, remotepath, callback=None, confirm=True,
-            preserve_mtime=True):
-        rem_tree = self._remote_tree(remotepath)
+            preserve_mtime=True, manifest=False, manifest_ttl=None):
+        # manifest=True caches the remote {rel: mtime} manifest on disk
+        # between syncs, skipping the full remote walk; manifest_ttl
+        # (seconds) caps how stale a cache is still trusted. Only safe
+        # when this client is the sole writer of the remote tree.
         loc_tree = self._local_tree(localpath)
 
+        keys = None
+        if manifest:
+            keys = self._load_manifest(remotepath, manifest_ttl)
+        if keys is None:
+            rem_tree = self._remote_tree(remotepath)
+            keys = {rem_tree._rel(p): int(p.stat().st_mtime)
+                    for p in rem_tree.paths}
+
         # Modified tree
-        tree = loc_tree.mod(rem_tree)
+        tree = loc_tree._mod_keys(keys)
 
-        self._put_tree(tree, remotepath, callback=callback, confirm=confirm,
-            preserve_mtime=preserve_mtime)
+        self._put_tree(tree, Path(remotepath), callback=callback,
+            confirm=confirm, preserve_mtime=preserve_mtime)
+
+        if manifest:
+            # the remote now mirrors the local tree for these entries
+            keys.update((loc_tree._rel(p), int(p.stat().st_mtime))
+                        for p in loc_tree.paths)
+            self._save_manifest(remotepath, keys)
 
     def rm(self):
         raise NotImplementedError
 
-    def _rm_tree(self, tree):
-        for rf in tree.files:
-            self.remove(rf)
-
-        for rd in reversed(tree.directories):
-            self.rmdir(rd)
+    def _request_many(self, cmd, requests, window=64):
+        # Queues up to `window` outstanding requests before reading any
+        # replies, instead of paying one round-trip per request.
+        # Replies are drained in submission order (SFTP servers reply
+        # in order); a failure raises as its reply is read.
+        pending = deque()
+        for args in requests:
+            if len(pending) >= window:
+                self._read_response(pending.popleft())
+            pending.append(self._async_request(type(None), cmd, *args))
+        while pending:
+            self._read_response(pending.popleft())
+
+    def _rm_tree(self, tree, window=64):
+        self._request_many(
+            sftp.CMD_REMOVE, ((str(rf),) for rf in tree.files), window)
+
+        # deepest directories first, so each is empty when removed
+        directories = sorted(
+            tree.directories, key=lambda d: str(d).count("/"), reverse=True)
+        self._request_many(
+            sftp.CMD_RMDIR, ((str(rd),) for rd in directories), window)
 
     def rm_r(self, remotepath, remove_root=False):
         tree = self._remote_tree(remotepath)
@@ -294,12 +568,24 @@ class ClientSFTPHandler(Handler):
 #  * tricky because the constructor is paramiko.sftp_client.SFTPClient.open
 # FileHandler is missing a .prefetch attribute
 class FileHandler(Handler):
-    def __init__(self, file_handler, encoding, errors, newline):
+    def __init__(self, file_handler, encoding, errors, newline, mode="rb"):
         self.file_handler = file_handler
         self.encoding = encoding
         self.errors = errors
         self.newline = newline
 
+        # SFTPFile.read/write are stop-and-wait: one request, one reply,
+        # one round-trip each. Prefetch pipelines the READs for a plain
+        # read; pipelined mode queues WRITEs without awaiting each reply
+        # (replies are drained on close).
+        if "r" in mode and "+" not in mode:
+            try:
+                self.file_handler.prefetch()
+            except IOError:
+                pass  # e.g. server without stat support
+        elif "w" in mode or "a" in mode or "+" in mode:
+            self.file_handler.set_pipelined(True)
+
     @property
     def prefetch(self):
         return self.file_handler.prefetch
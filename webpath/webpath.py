@@ -1,19 +1,24 @@
-import logging
 import io
 from paramiko import sftp, sftp_attr, sftp_file
+from pathlib import Path
 
 
 from stat import S_ISDIR, S_ISREG
 
-logging.basicConfig()
-logger = logging.getLogger(__name__)
-logger.setLevel(level=logging.DEBUG)
+
+# Sentinel cached by stat() for paths known not to exist, so repeated
+# is_dir()/is_file() calls on a missing path don't re-stat every time.
+_STAT_MISSING = object()
 
 
 class WebPath:
     """Partially copies the interface of pathlib.Path"""
     # Everywhere with __fspath__ should be removed once paramiko supports
     # the Path interface
+
+    # Instances are created per tree entry, so avoid a __dict__ each
+    __slots__ = ("_path", "_accessor", "_stat", "_posix_cache")
+
     def __init__(self, path, accessor=None, stat=None):
         # Reference to the sftp handler is necessary; in pathlib this is
         # equivalent to a reference to the os module; but this module is
@@ -26,14 +31,21 @@ class WebPath:
         self._path = path
         self._accessor = accessor  # sftp handler
         self._stat = stat  # cached stat
+        self._posix_cache = None  # cached as_posix string
 
     @classmethod
     def from_attr(cls, parent, accessor=None, stat=None):
         return cls(Path(parent) / stat.filename, accessor, stat)
 
     def stat(self):
+        if self._stat is _STAT_MISSING:
+            raise FileNotFoundError(self.__fspath__())
         if self._stat is None:
-            self._stat = self._accessor.stat(self._path.__fspath__())
+            try:
+                self._stat = self._accessor.stat(self._path.__fspath__())
+            except FileNotFoundError:
+                self._stat = _STAT_MISSING
+                raise
         return self._stat
 
     def _reset_stat(self):
@@ -48,11 +60,16 @@ class WebPath:
         return self._path.name
 
     def as_posix(self):
-        return self._path.as_posix()
+        # __fspath__/__str__/_rel funnel through here in the tree hot
+        # loops; the path never mutates, so compute the string once
+        if self._posix_cache is None:
+            self._posix_cache = self._path.as_posix()
+        return self._posix_cache
 
     def relative_to(self, ancestor):
         # loses stat information
-        return self.__class__(self._path.relative_to(ancestor), self._system)
+        return self.__class__(self._path.relative_to(ancestor),
+                              self._accessor)
 
     def __repr__(self):
         return f"{self.__class__.__name__}('{self.as_posix()}')"
@@ -140,7 +157,7 @@ class WebPath:
 
         try:
             self._accessor._request(sftp.CMD_CLOSE, handle)
-        except Excpetion as e:
+        except Exception:
             pass
 
     def unlink(self):